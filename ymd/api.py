@@ -8,6 +8,15 @@ from dataclasses import dataclass
 from yandex_music import Track
 from yandex_music.utils.sign_request import DEFAULT_SIGN_KEY
 
+GET_FILE_INFO_URL = "https://api.music.yandex.net/get-file-info"
+LOSSLESS_QUALITY = "lossless"
+LOSSLESS_CODECS = "flac,aac,he-aac,mp3"
+LOSSLESS_TRANSPORTS = "raw"
+# Everything after the timestamp and track ID is constant, and the key
+# schedule is only computed once.
+_SIGN_SUFFIX = LOSSLESS_QUALITY + LOSSLESS_CODECS.replace(",", "") + LOSSLESS_TRANSPORTS
+_SIGN_HMAC = hmac.new(DEFAULT_SIGN_KEY.encode(), digestmod=hashlib.sha256)
+
 
 @dataclass
 class LosslessDownloadInfo:
@@ -24,21 +33,16 @@ def get_lossless_info(track: Track) -> LosslessDownloadInfo:
     params = {
         "ts": timestamp,
         "trackId": track.id,
-        "quality": "lossless",
-        "codecs": "flac,aac,he-aac,mp3",
-        "transports": "raw",
+        "quality": LOSSLESS_QUALITY,
+        "codecs": LOSSLESS_CODECS,
+        "transports": LOSSLESS_TRANSPORTS,
     }
-    hmac_sign = hmac.new(
-        DEFAULT_SIGN_KEY.encode(),
-        "".join(str(e) for e in params.values()).replace(",", "").encode(),
-        hashlib.sha256,
-    )
+    hmac_sign = _SIGN_HMAC.copy()
+    hmac_sign.update(f"{timestamp}{track.id}{_SIGN_SUFFIX}".encode())
     sign = base64.b64encode(hmac_sign.digest()).decode()[:-1]
     params["sign"] = sign
 
-    resp = client.request.get(
-        "https://api.music.yandex.net/get-file-info", params=params
-    )
+    resp = client.request.get(GET_FILE_INFO_URL, params=params)
     resp = typing.cast(dict, resp)
     e = resp["download_info"]
     return LosslessDownloadInfo(
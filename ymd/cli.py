@@ -1,26 +1,42 @@
 #!/bin/python3
+from __future__ import annotations
+
 import argparse
 import itertools
 import logging
+import math
+import os
 import re
 import time
 import typing
 from argparse import ArgumentTypeError
 from collections.abc import Generator, Iterable
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import Optional, Union
+from typing import TYPE_CHECKING, Optional, Union
 from urllib.parse import urlparse
 
-from yandex_music import Album, Playlist, Track
+from ymd import constants
 
-from ymd import core
+if TYPE_CHECKING:
+    from yandex_music import Album, ArtistAlbums, Playlist, Track
 
 DEFAULT_DELAY = 0
-
-TRACK_RE = re.compile(r"track/(\d+)")
-ALBUM_RE = re.compile(r"album/(\d+)$")
-ARTIST_RE = re.compile(r"artist/(\d+)$")
-PLAYLIST_RE = re.compile(r"([\w\-._]+)/playlists/(\d+)$")
+DEFAULT_CONCURRENCY = 5
+PENDING_DOWNLOADS_PER_WORKER = 2
+# Cover and lyrics are fetched alongside each running download
+EXTRAS_PER_DOWNLOAD = 2
+FETCH_PAGE_SIZE = 50
+AUDIO_FILE_SUFFIXES = tuple(constants.AUDIO_FILE_SUFFIXES)
+
+# Artist and album URLs take priority over a track ID earlier in the path,
+# hence the lookahead on the only alternative that isn't anchored at the end
+URL_RE = re.compile(
+    r"artist/(?P<artist_id>\d+)$"
+    r"|album/(?P<album_id>\d+)$"
+    r"|track/(?P<track_id>\d+)(?!(?s:.*)(?:artist|album)/\d+$)"
+    r"|(?P<playlist_user>[\w\-._]+)/playlists/(?P<playlist_kind>\d+)$"
+)
 
 logger = logging.getLogger("yandex-music-downloader")
 
@@ -41,8 +57,8 @@ def quality_arg(astr: str) -> int:
 
 def compatibility_level_arg(astr: str) -> int:
     aint = int(astr)
-    min_val = core.MIN_COMPATIBILITY_LEVEL
-    max_val = core.MAX_COMPATIBILITY_LEVEL
+    min_val = constants.MIN_COMPATIBILITY_LEVEL
+    max_val = constants.MAX_COMPATIBILITY_LEVEL
     if min_val <= aint <= max_val:
         return aint
     raise ArgumentTypeError(
@@ -63,14 +79,16 @@ def cover_resolution_arg(astr: str) -> int:
     return int(astr)
 
 
-def lyrics_format_arg(astr: str) -> core.LyricsFormat:
+def lyrics_format_arg(astr: str) -> constants.LyricsFormat:
     try:
-        return core.LyricsFormat(astr)
+        return constants.LyricsFormat(astr)
     except ValueError:
-        raise ArgumentTypeError(f"Допустимые значения: {','.join(core.LyricsFormat)}")
+        raise ArgumentTypeError(
+            f"Допустимые значения: {','.join(constants.LyricsFormat)}"
+        )
 
 
-def main():
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         description="Загрузчик музыки с сервиса Яндекс.Музыка",
         formatter_class=argparse.RawTextHelpFormatter,
@@ -90,9 +108,9 @@ def main():
     common_group.add_argument(
         "--lyrics-format",
         type=lyrics_format_arg,
-        default=core.LyricsFormat.NONE,
+        default=constants.LyricsFormat.NONE,
         help=show_default("Формат текста песни"),
-        choices=core.LyricsFormat,
+        choices=constants.LyricsFormat,
     )
     common_group.add_argument(
         "--add-lyrics", action="store_true", help=argparse.SUPPRESS
@@ -102,7 +120,7 @@ def main():
     )
     common_group.add_argument(
         "--cover-resolution",
-        default=core.DEFAULT_COVER_RESOLUTION,
+        default=constants.DEFAULT_COVER_RESOLUTION,
         metavar="<Разрешение обложки>",
         type=cover_resolution_arg,
         help=show_default(
@@ -114,7 +132,9 @@ def main():
         default=DEFAULT_DELAY,
         metavar="<Задержка>",
         type=int,
-        help=show_default("Задержка между запросами, в секундах"),
+        help=show_default(
+            "Задержка между запросами, в секундах. Отключает параллельную загрузку"
+        ),
     )
     common_group.add_argument(
         "--stick-to-artist",
@@ -133,7 +153,7 @@ def main():
         default=1,
         type=compatibility_level_arg,
         help=show_default(
-            f"Уровень совместимости, от {core.MIN_COMPATIBILITY_LEVEL} до {core.MAX_COMPATIBILITY_LEVEL}. См. README для подробного описания"
+            f"Уровень совместимости, от {constants.MIN_COMPATIBILITY_LEVEL} до {constants.MAX_COMPATIBILITY_LEVEL}. См. README для подробного описания"
         ),
     )
     common_group.add_argument(
@@ -145,6 +165,15 @@ def main():
             "Время ожидания ответа от сервера, в секундах. Увеличьте если возникают сетевые ошибки"
         ),
     )
+    common_group.add_argument(
+        "--concurrency",
+        metavar="<Количество потоков>",
+        default=DEFAULT_CONCURRENCY,
+        type=natural_int_arg,
+        help=show_default(
+            "Количество треков, загружаемых одновременно. Игнорируется при --delay"
+        ),
+    )
     common_group.add_argument("--debug", action="store_true", help=argparse.SUPPRESS)
 
     id_group_meta = parser.add_argument_group("ID")
@@ -173,7 +202,7 @@ def main():
     )
     path_group.add_argument(
         "--path-pattern",
-        default=core.DEFAULT_PATH_PATTERN,
+        default=constants.DEFAULT_PATH_PATTERN,
         metavar="<Паттерн>",
         type=Path,
         help=show_default(
@@ -191,6 +220,35 @@ def main():
         help="Токен для авторизации. См. README для способов получения",
     )
 
+    return parser
+
+
+def is_track_downloaded(
+    save_path: Path, dir_listings: dict[Path, dict[str, str]]
+) -> bool:
+    save_dir = save_path.parent
+    listing = dir_listings.get(save_dir)
+    if listing is None:
+        try:
+            with os.scandir(save_dir) as entries:
+                listing = {e.name.casefold(): e.name for e in entries}
+        except OSError:
+            listing = {}
+        dir_listings[save_dir] = listing
+    for suffix in AUDIO_FILE_SUFFIXES:
+        name = save_path.name + suffix
+        existing_name = listing.get(name.casefold())
+        if existing_name is None:
+            continue
+        # Names differing only in case are the same file on case-insensitive
+        # filesystems (Windows, macOS), let the filesystem decide
+        if existing_name == name or os.path.isfile(save_dir / name):
+            return True
+    return False
+
+
+def main():
+    parser = build_parser()
     args = parser.parse_args()
 
     logging.basicConfig(
@@ -199,28 +257,33 @@ def main():
         level=logging.DEBUG if args.debug else logging.ERROR,
     )
 
+    if args.delay > 0:
+        # The delay spaces out requests, which only holds for a single worker
+        args.concurrency = 1
+
     if args.add_lyrics:
         print(
             "Аргумент --add-lyrics устарел и будет удален в будущем. Используйте --lyrics-format"
         )
-        args.lyrics_format = core.LyricsFormat.TEXT
+        args.lyrics_format = constants.LyricsFormat.TEXT
 
     if args.url is not None:
         parsed_url = urlparse(args.url)
-        path = parsed_url.path
-        if match := ARTIST_RE.search(path):
-            args.artist_id = match.group(1)
-        elif match := ALBUM_RE.search(path):
-            args.album_id = match.group(1)
-        elif match := TRACK_RE.search(path):
-            args.track_id = match.group(1)
-        elif match := PLAYLIST_RE.search(path):
-            args.playlist_id = match.group(1) + "/" + match.group(2)
-        else:
+        match = URL_RE.search(parsed_url.path)
+        if match is None:
             print("Параметер url указан в неверном формате")
             return 1
+        id_name = typing.cast(str, match.lastgroup)
+        if id_name == "playlist_kind":
+            args.playlist_id = match["playlist_user"] + "/" + match[id_name]
+        else:
+            setattr(args, id_name, match[id_name])
+
+    from ymd import core, http_utils
 
-    client = core.init_client(args.token, args.timeout)
+    client = core.init_client(
+        args.token, args.timeout, args.concurrency * (1 + EXTRAS_PER_DOWNLOAD)
+    )
     result_tracks: Iterable[Track] = []
 
     def album_tracks_gen(album_ids: Iterable[Union[int, str]]) -> Generator[Track]:
@@ -230,35 +293,51 @@ def main():
                     yield from itertools.chain.from_iterable(volumes)
 
     if args.artist_id is not None:
+        artist_id = int(args.artist_id)
+        only_music = args.only_music
+        stick_to_artist = args.stick_to_artist
 
         def filter_album(album: Album) -> bool:
             title = album.title
             if album.id is None or not album.available:
                 print(f'Альбом "{title}" не доступен для скачивания')
-            elif args.only_music and album.meta_type != "music":
+            elif only_music and album.meta_type != "music":
                 print(f'Альбом "{title}" пропущен' " т.к. не является музыкальным")
-            elif args.stick_to_artist and album.artists[0].id != int(args.artist_id):
+            elif stick_to_artist and album.artists[0].id != artist_id:
                 print(f'Альбом "{title}" пропущен' " из-за флага --stick-to-artist")
             else:
                 return True
             return False
 
-        def albums_gen() -> Generator[Album]:
-            has_next = True
-            page = 0
-            while has_next:
-                if albums := client.artists_direct_albums(args.artist_id, page):
-                    yield from albums.albums
-                else:
-                    break
-                if pager := albums.pager:
-                    page = pager.page + 1
-                    has_next = pager.per_page * page < pager.total
-                else:
-                    break
+        def fetch_albums_page(page: int) -> Optional[ArtistAlbums]:
+            return client.artists_direct_albums(args.artist_id, page)
+
+        def fetch_albums() -> list[Album]:
+            if not (first_page := fetch_albums_page(0)):
+                return []
+            albums = list(first_page.albums)
+            if not (pager := first_page.pager):
+                return albums
+            if not pager.per_page or pager.total is None:
+                # Page count is unknown, keep going until an empty page
+                page = pager.page + 1
+                while (page_albums := fetch_albums_page(page)) and page_albums.albums:
+                    albums.extend(page_albums.albums)
+                    page += 1
+                return albums
+            page_count = math.ceil(pager.total / pager.per_page)
+            if page_count <= pager.page + 1:
+                return albums
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                pages = range(pager.page + 1, page_count)
+                for page_albums in executor.map(fetch_albums_page, pages):
+                    if not page_albums:
+                        break
+                    albums.extend(page_albums.albums)
+            return albums
 
         result_tracks = album_tracks_gen(
-            a.id for a in albums_gen() if filter_album(a) and a.id is not None
+            a.id for a in fetch_albums() if filter_album(a) and a.id is not None
         )
     elif args.album_id is not None:
         result_tracks = album_tracks_gen((args.album_id,))
@@ -267,50 +346,102 @@ def main():
         result_tracks = track
     elif args.playlist_id is not None:
         user, kind = args.playlist_id.split("/")
-        playlist = typing.cast(Playlist, client.users_playlists(kind, user))
+        playlist = typing.cast("Playlist", client.users_playlists(kind, user))
 
         def playlist_tracks_gen() -> Generator[Track]:
-            tracks = playlist.fetch_tracks()
-            for track in tracks:
-                yield track.fetch_track()
+            track_ids = [t.track_id for t in playlist.fetch_tracks()]
+            batches = [
+                track_ids[i : i + FETCH_PAGE_SIZE]
+                for i in range(0, len(track_ids), FETCH_PAGE_SIZE)
+            ]
+            if not batches:
+                return
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                next_tracks = executor.submit(client.tracks, batches[0])
+                for batch in batches[1:]:
+                    tracks = next_tracks.result()
+                    next_tracks = executor.submit(client.tracks, batch)
+                    yield from tracks
+                yield from next_tracks.result()
 
         result_tracks = playlist_tracks_gen()
 
-    covers_cache: dict[int, bytes] = {}
-    for track in result_tracks:
-        if not track.available:
-            print(f"Трек {track.title} не доступен для скачивания")
-            continue
+    path_pattern = core.compile_path_pattern(args.path_pattern)
+    covers_cache: dict[int, Future[core.AlbumCover]] = {}
+    album_tags_cache: dict[int, core.AlbumTags] = {}
+    dir_listings: dict[Path, dict[str, str]] = {}
+    created_dirs: set[Path] = set()
+    pending_downloads: set[Future] = set()
+    downloads_by_path: dict[Path, Future] = {}
+    max_pending_downloads = args.concurrency * PENDING_DOWNLOADS_PER_WORKER
+    extras_executor = ThreadPoolExecutor(
+        max_workers=args.concurrency * EXTRAS_PER_DOWNLOAD
+    )
+    executor = ThreadPoolExecutor(max_workers=args.concurrency)
+    try:
+        for track in result_tracks:
+            if not track.available:
+                print(f"Трек {track.title} не доступен для скачивания")
+                continue
 
-        save_path = args.dir / core.prepare_base_path(
-            args.path_pattern,
-            track,
-            args.unsafe_path,
-        )
-        if args.skip_existing:
-            if any(
-                Path(str(save_path) + s).is_file() for s in core.AUDIO_FILE_SUFFIXES
-            ):
+            save_path = args.dir / core.prepare_base_path(
+                path_pattern,
+                track,
+                args.unsafe_path,
+            )
+            if args.skip_existing and is_track_downloaded(save_path, dir_listings):
                 continue
 
-        save_dir = save_path.parent
-        if not save_dir.is_dir():
-            save_dir.mkdir(parents=True)
-
-        downloadable = core.to_downloadable_track(track, args.quality, save_path)
-        bitrate = downloadable.bitrate
-        format_info = "[" + downloadable.codec.upper()
-        if bitrate > 0:
-            format_info += f" {bitrate}kbps"
-        format_info += "]"
-        print(f"{format_info} Загружается {downloadable.path}")
-        core.download_track(
-            track_info=downloadable,
-            lyrics_format=args.lyrics_format,
-            embed_cover=args.embed_cover,
-            cover_resolution=args.cover_resolution,
-            covers_cache=covers_cache,
-            compatibility_level=args.compatibility_level,
-        )
-        if args.delay > 0:
-            time.sleep(args.delay)
+            save_dir = save_path.parent
+            if save_dir not in created_dirs:
+                save_dir.mkdir(parents=True, exist_ok=True)
+                created_dirs.add(save_dir)
+
+            downloadable = core.to_downloadable_track(track, args.quality, save_path)
+            format_info = downloadable.codec.upper()
+            if downloadable.bitrate > 0:
+                format_info += f" {downloadable.bitrate}kbps"
+            print(f"[{format_info}] Загружается {downloadable.path}")
+            if (listing := dir_listings.get(save_dir)) is not None:
+                name = downloadable.path.name
+                listing[name.casefold()] = name
+            if (previous := downloads_by_path.get(downloadable.path)) is not None:
+                # Same target as an earlier track: let it finish first, so
+                # the later track overwrites it like a sequential run would
+                previous.result()
+            download = executor.submit(
+                core.download_track,
+                track_info=downloadable,
+                lyrics_format=args.lyrics_format,
+                embed_cover=args.embed_cover,
+                cover_resolution=args.cover_resolution,
+                covers_cache=covers_cache,
+                compatibility_level=args.compatibility_level,
+                extras_executor=extras_executor,
+                album_tags_cache=album_tags_cache,
+            )
+            downloads_by_path[downloadable.path] = download
+            pending_downloads.add(download)
+            while len(pending_downloads) > max_pending_downloads:
+                # Wake up on the first finished download, so a failure stops
+                # the run without waiting for the ones queued before it
+                done, pending_downloads = wait(
+                    pending_downloads, return_when=FIRST_COMPLETED
+                )
+                for future in done:
+                    future.result()
+            if args.delay > 0:
+                # Space out whole downloads, not just their submission
+                download.result()
+                time.sleep(args.delay)
+        for future in pending_downloads:
+            future.result()
+    except BaseException:
+        # Don't start the queued downloads after an error or Ctrl-C and stop
+        # the running ones, they remove their partial files on the way out
+        http_utils.cancel_downloads()
+        executor.shutdown(wait=False, cancel_futures=True)
+        extras_executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+    extras_executor.shutdown()
@@ -0,0 +1,18 @@
+from enum import auto
+from pathlib import Path
+
+from strenum import LowercaseStrEnum
+
+DEFAULT_PATH_PATTERN = Path("#album-artist", "#album", "#number - #title")
+DEFAULT_COVER_RESOLUTION = 400
+
+MIN_COMPATIBILITY_LEVEL = 0
+MAX_COMPATIBILITY_LEVEL = 1
+
+AUDIO_FILE_SUFFIXES = {".mp3", ".flac", ".m4a"}
+
+
+class LyricsFormat(LowercaseStrEnum):
+    NONE = auto()
+    TEXT = auto()
+    LRC = auto()
@@ -1,13 +1,16 @@
 import datetime as dt
+import functools
+import os
 import random
 import re
+import threading
 import typing
+import uuid
+from concurrent.futures import Executor, Future
 from dataclasses import dataclass
-from enum import auto
 from pathlib import Path
-from typing import Optional, Union
+from typing import Callable, Optional, Union
 
-import mutagen
 from mutagen.flac import FLAC, Picture
 from mutagen.id3._frames import (
     APIC,
@@ -24,32 +27,67 @@ from mutagen.id3._frames import (
 from mutagen.id3._specs import ID3TimeStamp, PictureType
 from mutagen.mp3 import MP3
 from mutagen.mp4 import MP4, MP4Cover
-from strenum import LowercaseStrEnum
-from yandex_music import Client, DownloadInfo, Track, YandexMusicObject
+from yandex_music import (
+    Album,
+    Client,
+    DownloadInfo,
+    Track,
+    TrackLyrics,
+    YandexMusicObject,
+)
 
+from ymd import http_utils
+from ymd.constants import (  # noqa: F401
+    AUDIO_FILE_SUFFIXES,
+    DEFAULT_COVER_RESOLUTION,
+    DEFAULT_PATH_PATTERN,
+    MAX_COMPATIBILITY_LEVEL,
+    MIN_COMPATIBILITY_LEVEL,
+    LyricsFormat,
+)
 from ymd.api import get_lossless_info
 from ymd.mime_utils import MimeType, guess_mime_type
 
 UNSAFE_PATH_CLEAR_RE = re.compile(r"[/\\]+")
 SAFE_PATH_CLEAR_RE = re.compile(r"([^\w\-\'() ]|^\s+|\s+$)")
+# Equivalent of SAFE_PATH_CLEAR_RE for ASCII strings without leading or
+# trailing whitespace, where only the character class can match
+SAFE_PATH_ASCII_TABLE = str.maketrans(
+    {c: "_" for c in map(chr, range(128)) if not (c.isalnum() or c in "_-'() ")}
+)
 
-DEFAULT_PATH_PATTERN = Path("#album-artist", "#album", "#number - #title")
-DEFAULT_COVER_RESOLUTION = 400
-
-MIN_COMPATIBILITY_LEVEL = 0
-MAX_COMPATIBILITY_LEVEL = 1
-
-AUDIO_FILE_SUFFIXES = {".mp3", ".flac", ".m4a"}
+PATH_PLACEHOLDERS = (
+    "#number-padded",
+    "#album-artist",
+    "#artist-id",
+    "#album-id",
+    "#track-id",
+    "#number",
+    "#artist",
+    "#title",
+    "#album",
+    "#year",
+)
+PLACEHOLDER_RE = re.compile(
+    "("
+    + "|".join(re.escape(p) for p in sorted(PATH_PLACEHOLDERS, key=len, reverse=True))
+    + ")"
+)
 
+LOSSY_CODECS = frozenset(("mp3", "aac"))
+MIME_SUFFIX_MAPPING = {MimeType.JPEG: ".jpg", MimeType.PNG: ".png"}
+MIME_MP4_FORMAT_MAPPING = {
+    MimeType.JPEG: MP4Cover.FORMAT_JPEG,
+    MimeType.PNG: MP4Cover.FORMAT_PNG,
+}
 
-class LyricsFormat(LowercaseStrEnum):
-    NONE = auto()
-    TEXT = auto()
-    LRC = auto()
+_covers_cache_lock = threading.Lock()
 
 
 @dataclass
 class DownloadableTrack:
+    __slots__ = ("url", "bitrate", "codec", "path", "track")
+
     url: str
     bitrate: int
     codec: str
@@ -59,13 +97,55 @@ class DownloadableTrack:
 
 @dataclass
 class AlbumCover:
+    __slots__ = ("data", "mime_type")
+
     data: bytes
     mime_type: MimeType
 
 
-def init_client(token: str, timeout: int) -> Client:
+@dataclass
+class AlbumTags:
+    __slots__ = (
+        "title",
+        "artists",
+        "release_year",
+        "iso8601_release_date",
+        "date",
+        "id3_date",
+    )
+
+    title: Optional[str]
+    artists: list[str]
+    release_year: Optional[str]
+    iso8601_release_date: Optional[str]
+    date: Optional[str]
+    id3_date: Optional[ID3TimeStamp]
+
+
+@dataclass
+class TrackTags:
+    __slots__ = ("title", "artists", "number", "disc_number", "url")
+
+    title: Optional[str]
+    artists: list[str]
+    number: Optional[int]
+    disc_number: Optional[int]
+    url: str
+
+
+@dataclass
+class CompiledPathPattern:
+    literals: list[str]
+    placeholders: list[str]
+
+
+def init_client(
+    token: str, timeout: int, pool_size: int = http_utils.DEFAULT_POOL_SIZE
+) -> Client:
     client = Client(token)
     client.request.set_timeout(timeout)
+    http_utils.set_timeout(timeout)
+    http_utils.set_pool_size(pool_size)
     return client.init()
 
 
@@ -78,10 +158,29 @@ def full_title(obj: YandexMusicObject) -> Optional[str]:
     return result
 
 
+@functools.lru_cache(maxsize=4096)
+def _sanitize(value: str, unsafe_path: bool) -> str:
+    if not unsafe_path:
+        if value.isascii() and not value[:1].isspace() and not value[-1:].isspace():
+            return value.translate(SAFE_PATH_ASCII_TABLE)
+        clear_re = SAFE_PATH_CLEAR_RE
+    else:
+        clear_re = UNSAFE_PATH_CLEAR_RE
+    return clear_re.sub("_", value)
+
+
+def compile_path_pattern(path_pattern: Path) -> CompiledPathPattern:
+    parts = PLACEHOLDER_RE.split(str(path_pattern))
+    return CompiledPathPattern(literals=parts[::2], placeholders=parts[1::2])
+
+
 def prepare_base_path(
-    path_pattern: Path, track: Track, unsafe_path: bool = False
+    path_pattern: Union[Path, CompiledPathPattern],
+    track: Track,
+    unsafe_path: bool = False,
 ) -> Path:
-    path_str = str(path_pattern)
+    if isinstance(path_pattern, Path):
+        path_pattern = compile_path_pattern(path_pattern)
     album = None
     artist = None
     track_position = None
@@ -106,15 +205,164 @@ def prepare_base_path(
         "#album": full_title(album) if album else None,
         "#year": album.year if album else None,
     }
-    for placeholder, replacement in repl_dict.items():
-        replacement = str(replacement)
-        if not unsafe_path:
-            clear_re = SAFE_PATH_CLEAR_RE
-        else:
-            clear_re = UNSAFE_PATH_CLEAR_RE
-        replacement = clear_re.sub("_", replacement)
-        path_str = path_str.replace(placeholder, replacement)
-    return Path(path_str)
+    literals = path_pattern.literals
+    path_parts = [literals[0]]
+    for placeholder, literal in zip(path_pattern.placeholders, literals[1:]):
+        path_parts.append(_sanitize(str(repl_dict[placeholder]), unsafe_path))
+        path_parts.append(literal)
+    return Path("".join(path_parts))
+
+
+def build_album_tags(album: Album) -> AlbumTags:
+    iso8601_release_date = None
+    release_year: Optional[str] = None
+    if album.release_date is not None:
+        release_date = dt.datetime.fromisoformat(album.release_date).astimezone(
+            dt.timezone.utc
+        )
+        release_year = str(release_date.year)
+        iso8601_release_date = release_date.strftime("%Y-%m-%d %H:%M:%S")
+    if year := album.year:
+        release_year = str(year)
+    date = iso8601_release_date or release_year
+    return AlbumTags(
+        title=full_title(album),
+        artists=[a.name for a in album.artists if a.name],
+        release_year=release_year,
+        iso8601_release_date=iso8601_release_date,
+        date=date,
+        id3_date=ID3TimeStamp(date) if date else None,
+    )
+
+
+def get_album_tags(
+    album: Album, album_tags_cache: Optional[dict[int, AlbumTags]] = None
+) -> AlbumTags:
+    if album.id is None or album_tags_cache is None:
+        return build_album_tags(album)
+    album_tags = album_tags_cache.get(album.id)
+    if album_tags is None:
+        album_tags = album_tags_cache[album.id] = build_album_tags(album)
+    return album_tags
+
+
+def _set_mp3_tags(
+    tag: MP3,
+    track_tags: TrackTags,
+    album_tags: AlbumTags,
+    lyrics: Optional[str],
+    album_cover: Optional[AlbumCover],
+    compatibility_level: int,
+) -> None:
+    tag["TIT2"] = TIT2(encoding=3, text=track_tags.title)
+    tag["TALB"] = TALB(encoding=3, text=album_tags.title)
+    tag["TPE1"] = TPE1(encoding=3, text=track_tags.artists)
+    tag["TPE2"] = TPE2(encoding=3, text=album_tags.artists)
+
+    if album_tags.id3_date is not None:
+        tag["TDRC"] = TDRC(encoding=3, text=[album_tags.id3_date])
+    if track_tags.number:
+        tag["TRCK"] = TRCK(encoding=3, text=str(track_tags.number))
+    if track_tags.disc_number:
+        tag["TPOS"] = TPOS(encoding=3, text=str(track_tags.disc_number))
+
+    if lyrics:
+        tag["USLT"] = USLT(encoding=3, text=lyrics)
+    if album_cover:
+        tag["APIC"] = APIC(
+            encoding=3,
+            mime=album_cover.mime_type.value,
+            type=3,
+            data=album_cover.data,
+        )
+
+    tag["WOAF"] = WOAF(
+        encoding=3,
+        text=track_tags.url,
+    )
+
+
+def _set_mp4_tags(
+    tag: MP4,
+    track_tags: TrackTags,
+    album_tags: AlbumTags,
+    lyrics: Optional[str],
+    album_cover: Optional[AlbumCover],
+    compatibility_level: int,
+) -> None:
+    tag["\xa9nam"] = track_tags.title
+    tag["\xa9alb"] = album_tags.title
+    artists_value = track_tags.artists
+    album_artists_value = album_tags.artists
+    if compatibility_level == 1:
+        artists_value = "; ".join(track_tags.artists)
+        album_artists_value = "; ".join(album_tags.artists)
+    tag["\xa9ART"] = artists_value
+    tag["aART"] = album_artists_value
+
+    if album_tags.iso8601_release_date is not None:
+        tag["rldt"] = album_tags.iso8601_release_date
+    if album_tags.release_year is not None:
+        tag["\xa9day"] = album_tags.release_year
+    if track_tags.number:
+        tag["trkn"] = [(track_tags.number, 0)]
+    if track_tags.disc_number:
+        tag["disk"] = [(track_tags.disc_number, 0)]
+
+    if lyrics:
+        tag["\xa9lyr"] = lyrics
+    if album_cover:
+        mp4_image_format = MIME_MP4_FORMAT_MAPPING.get(album_cover.mime_type)
+        if mp4_image_format is None:
+            raise RuntimeError("Unsupported cover type")
+        tag["covr"] = [MP4Cover(album_cover.data, imageformat=mp4_image_format)]
+    tag["\xa9cmt"] = track_tags.url
+
+
+def _set_flac_tags(
+    tag: FLAC,
+    track_tags: TrackTags,
+    album_tags: AlbumTags,
+    lyrics: Optional[str],
+    album_cover: Optional[AlbumCover],
+    compatibility_level: int,
+) -> None:
+    tag["title"] = track_tags.title
+    tag["album"] = album_tags.title
+    tag["artist"] = track_tags.artists
+    tag["albumartist"] = album_tags.artists
+
+    if album_tags.date:
+        tag["date"] = album_tags.date
+    if track_tags.number:
+        tag["tracknumber"] = str(track_tags.number)
+    if track_tags.disc_number:
+        tag["discnumber"] = str(track_tags.disc_number)
+
+    if lyrics:
+        tag["lyrics"] = lyrics
+    if album_cover is not None:
+        pic = Picture()
+        pic.type = PictureType.COVER_FRONT
+        pic.data = album_cover.data
+        pic.mime = album_cover.mime_type.value
+        tag.add_picture(pic)
+    tag["comment"] = track_tags.url
+
+
+TAGGING_BUFFER_SIZE = 64 * 1024
+
+SUFFIX_MUTAGEN_MAPPING: dict[str, type] = {
+    ".mp3": MP3,
+    ".m4a": MP4,
+    ".flac": FLAC,
+}
+
+TAG_WRITERS: dict[type, Callable[..., None]] = {
+    MP3: _set_mp3_tags,
+    MP4: _set_mp4_tags,
+    FLAC: _set_flac_tags,
+}
 
 
 def set_tags(
@@ -123,115 +371,108 @@ def set_tags(
     lyrics: Optional[str],
     album_cover: Optional[AlbumCover],
     compatibility_level: int,
+    album_tags_cache: Optional[dict[int, AlbumTags]] = None,
 ) -> None:
     album = track.albums[0]
-    track_artists = [a.name for a in track.artists if a.name]
-    album_artists = [a.name for a in album.artists if a.name]
-    tag = mutagen.File(path, [MP3, MP4, FLAC])  # type: ignore
-    album_title = full_title(album)
-    track_title = full_title(track)
+    file_type = SUFFIX_MUTAGEN_MAPPING.get(path.suffix)
+    if file_type is None:
+        raise RuntimeError("Unknown file format")
     track_number = None
     disc_number = None
     if position := album.track_position:
         track_number = position.index
         disc_number = position.volume
-    iso8601_release_date = None
-    release_year: Optional[str] = None
-    if album.release_date is not None:
-        iso8601_release_date = dt.datetime.fromisoformat(album.release_date).astimezone(
-            dt.timezone.utc
-        )
-        release_year = str(iso8601_release_date.year)
-        iso8601_release_date = iso8601_release_date.strftime("%Y-%m-%d %H:%M:%S")
-    if year := album.year:
-        release_year = str(year)
-    track_url = f"https://music.yandex.ru/album/{album.id}/track/{track.id}"
-
-    if isinstance(tag, MP3):
-        tag["TIT2"] = TIT2(encoding=3, text=track_title)
-        tag["TALB"] = TALB(encoding=3, text=album_title)
-        tag["TPE1"] = TPE1(encoding=3, text=track_artists)
-        tag["TPE2"] = TPE2(encoding=3, text=album_artists)
-
-        if tdrc_text := iso8601_release_date or release_year:
-            tag["TDRC"] = TDRC(encoding=3, text=[ID3TimeStamp(tdrc_text)])
-        if track_number:
-            tag["TRCK"] = TRCK(encoding=3, text=str(track_number))
-        if disc_number:
-            tag["TPOS"] = TPOS(encoding=3, text=str(disc_number))
-
-        if lyrics:
-            tag["USLT"] = USLT(encoding=3, text=lyrics)
-        if album_cover:
-            tag["APIC"] = APIC(
-                encoding=3,
-                mime=album_cover.mime_type.value,
-                type=3,
-                data=album_cover.data,
-            )
+    track_tags = TrackTags(
+        title=full_title(track),
+        artists=[a.name for a in track.artists if a.name],
+        number=track_number,
+        disc_number=disc_number,
+        url=f"https://music.yandex.ru/album/{album.id}/track/{track.id}",
+    )
 
-        tag["WOAF"] = WOAF(
-            encoding=3,
-            text=track_url,
+    album_tags = get_album_tags(album, album_tags_cache)
+
+    with open(path, "r+b", buffering=TAGGING_BUFFER_SIZE) as f:
+        tag = file_type(f)
+        TAG_WRITERS[file_type](
+            tag, track_tags, album_tags, lyrics, album_cover, compatibility_level
         )
-    elif isinstance(tag, MP4):
-        tag["\xa9nam"] = track_title
-        tag["\xa9alb"] = album_title
-        artists_value = track_artists
-        album_artists_value = album_artists
-        if compatibility_level == 1:
-            artists_value = "; ".join(track_artists)
-            album_artists_value = "; ".join(album_artists)
-        tag["\xa9ART"] = artists_value
-        tag["aART"] = album_artists_value
-
-        if iso8601_release_date is not None:
-            tag["rldt"] = iso8601_release_date
-        if release_year is not None:
-            tag["\xa9day"] = release_year
-        if track_number:
-            tag["trkn"] = [(track_number, 0)]
-        if disc_number:
-            tag["disk"] = [(disc_number, 0)]
-
-        if lyrics:
-            tag["\xa9lyr"] = lyrics
-        if album_cover:
-            mime_mp4_dict = {
-                MimeType.JPEG: MP4Cover.FORMAT_JPEG,
-                MimeType.PNG: MP4Cover.FORMAT_PNG,
-            }
-            mp4_image_format = mime_mp4_dict.get(album_cover.mime_type)
-            if mp4_image_format is None:
-                raise RuntimeError("Unsupported cover type")
-            tag["covr"] = [MP4Cover(album_cover.data, imageformat=mp4_image_format)]
-        tag["\xa9cmt"] = track_url
-    elif isinstance(tag, FLAC):
-        tag["title"] = track_title
-        tag["album"] = album_title
-        tag["artist"] = track_artists
-        tag["albumartist"] = album_artists
-
-        if date_text := iso8601_release_date or release_year:
-            tag["date"] = date_text
-        if track_number:
-            tag["tracknumber"] = str(track_number)
-        if disc_number:
-            tag["discnumber"] = str(disc_number)
-
-        if lyrics:
-            tag["lyrics"] = lyrics
-        if album_cover is not None:
-            pic = Picture()
-            pic.type = PictureType.COVER_FRONT
-            pic.data = album_cover.data
-            pic.mime = album_cover.mime_type.value
-            tag.add_picture(pic)
-        tag["comment"] = track_url
+        f.seek(0)
+        tag.save(f)
+
+
+def fetch_lyrics(track_lyrics: TrackLyrics) -> str:
+    return http_utils.retrieve(track_lyrics.download_url).decode("utf-8")
+
+
+def download_lyrics(
+    track: Track, lyrics_format: LyricsFormat, target_path: Path
+) -> tuple[Optional[str], Optional[str]]:
+    if lyrics_format == LyricsFormat.NONE or not (lyrics_info := track.lyrics_info):
+        return None, None
+    if lyrics_format == LyricsFormat.LRC and lyrics_info.has_available_sync_lyrics:
+        if target_path.with_suffix(".lrc").is_file():
+            return None, None
+        if track_lyrics := track.get_lyrics(format="LRC"):
+            return None, fetch_lyrics(track_lyrics)
+    elif lyrics_info.has_available_text_lyrics:
+        if track_lyrics := track.get_lyrics(format="TEXT"):
+            return fetch_lyrics(track_lyrics), None
+    return None, None
+
+
+def fetch_cover(track: Track, cover_resolution: int) -> AlbumCover:
+    if cover_resolution == -1:
+        cover_size = "orig"
     else:
-        raise RuntimeError("Unknown file format")
+        cover_size = f"{cover_resolution}x{cover_resolution}"
+    cover_bytes = http_utils.retrieve(track.get_cover_url(cover_size))
+    mime_type = guess_mime_type(cover_bytes)
+    if mime_type is None:
+        raise RuntimeError("Unknown cover mime type")
+    return AlbumCover(data=cover_bytes, mime_type=mime_type)
+
 
-    tag.save()
+def download_cover(
+    track: Track,
+    cover_resolution: int,
+    embed_cover: bool,
+    covers_cache: dict[int, Future[AlbumCover]],
+    target_path: Path,
+) -> Optional[AlbumCover]:
+    if track.cover_uri is None:
+        return None
+    if embed_cover:
+        album_id = track.albums[0].id
+        if not album_id:
+            return None
+        with _covers_cache_lock:
+            cover_future = covers_cache.get(album_id)
+            is_fetcher = cover_future is None
+            if cover_future is None:
+                cover_future = covers_cache[album_id] = Future()
+        if is_fetcher:
+            try:
+                cover_future.set_result(fetch_cover(track, cover_resolution))
+            except BaseException as e:
+                cover_future.set_exception(e)
+                raise
+        return cover_future.result()
+
+    cover_dir = target_path.parent
+    if any(
+        (cover_dir / ("cover" + suffix)).is_file()
+        for suffix in MIME_SUFFIX_MAPPING.values()
+    ):
+        return None
+    album_cover = fetch_cover(track, cover_resolution)
+    file_suffix = MIME_SUFFIX_MAPPING.get(album_cover.mime_type)
+    if file_suffix is None:
+        raise RuntimeError("Unknown mime type")
+    cover_path = cover_dir / ("cover" + file_suffix)
+    if not cover_path.is_file():
+        cover_path.write_bytes(album_cover.data)
+    return None
 
 
 def download_track(
@@ -239,61 +480,68 @@ def download_track(
     cover_resolution: int = DEFAULT_COVER_RESOLUTION,
     lyrics_format: LyricsFormat = LyricsFormat.NONE,
     embed_cover: bool = False,
-    covers_cache: Optional[dict[int, AlbumCover]] = None,
+    covers_cache: Optional[dict[int, Future[AlbumCover]]] = None,
     compatibility_level: int = 1,
+    extras_executor: Optional[Executor] = None,
+    album_tags_cache: Optional[dict[int, AlbumTags]] = None,
 ):
     if embed_cover and covers_cache is None:
         raise RuntimeError("covers_cache isn't provided")
-    covers_cache = typing.cast(dict[int, AlbumCover], covers_cache)
+    covers_cache = typing.cast(dict[int, Future[AlbumCover]], covers_cache)
     target_path = track_info.path
     track = track_info.track
-    client = track.client
-    assert client
-    album = track.albums[0]
+    # Unique per call, so workers writing the same target don't share it
+    temporary_path = target_path.with_name(
+        f".{uuid.uuid4().hex[:8]}.part{target_path.suffix}"
+    )
+    open(temporary_path, "xb").close()
 
-    client.request.download(track_info.url, str(target_path))
-
-    text_lyrics = None
-    if lyrics_format != LyricsFormat.NONE and (lyrics_info := track.lyrics_info):
-        if lyrics_format == LyricsFormat.LRC and lyrics_info.has_available_sync_lyrics:
-            if track_lyrics := track.get_lyrics(format="LRC"):
-                lrc_lyrics = track_lyrics.fetch_lyrics()
-                lrc_path = target_path.with_suffix(".lrc")
-                if not lrc_path.is_file():
-                    with open(lrc_path, "w", encoding="utf-8") as f:
-                        f.write(lrc_lyrics)
-        elif lyrics_info.has_available_text_lyrics:
-            if track_lyrics := track.get_lyrics(format="TEXT"):
-                text_lyrics = track_lyrics.fetch_lyrics()
-
-    cover = None
-    if track.cover_uri is not None:
-        if cover_resolution == -1:
-            cover_size = "orig"
-        else:
-            cover_size = f"{cover_resolution}x{cover_resolution}"
-        cover_bytes = track.download_cover_bytes(size=cover_size)
-        mime_type = guess_mime_type(cover_bytes)
-        if mime_type is None:
-            raise RuntimeError("Unknown cover mime type")
-        album_cover = AlbumCover(data=cover_bytes, mime_type=mime_type)
-        if embed_cover:
-            album_id = album.id
-            if album_id and (cached_cover := covers_cache.get(album_id)):
-                cover = cached_cover
-            else:
-                if album_id:
-                    cover = covers_cache[album_id] = album_cover
+    try:
+        if extras_executor is not None:
+            lyrics_future = extras_executor.submit(
+                download_lyrics, track, lyrics_format, target_path
+            )
+            cover_future = extras_executor.submit(
+                download_cover,
+                track,
+                cover_resolution,
+                embed_cover,
+                covers_cache,
+                target_path,
+            )
+            http_utils.download(track_info.url, temporary_path)
+            text_lyrics, lrc_lyrics = lyrics_future.result()
+            cover = cover_future.result()
         else:
-            mime_suffix_dict = {MimeType.JPEG: ".jpg", MimeType.PNG: ".png"}
-            file_suffix = mime_suffix_dict.get(album_cover.mime_type)
-            if file_suffix is None:
-                raise RuntimeError("Unknown mime type")
-            cover_path = target_path.parent / ("cover" + file_suffix)
-            if not cover_path.is_file():
-                cover_path.write_bytes(album_cover.data)
+            http_utils.download(track_info.url, temporary_path)
+            text_lyrics, lrc_lyrics = download_lyrics(track, lyrics_format, target_path)
+            cover = download_cover(
+                track, cover_resolution, embed_cover, covers_cache, target_path
+            )
+        set_tags(
+            temporary_path,
+            track,
+            text_lyrics,
+            cover,
+            compatibility_level,
+            album_tags_cache,
+        )
+        os.replace(temporary_path, target_path)
+    finally:
+        temporary_path.unlink(missing_ok=True)
+    if lrc_lyrics is not None:
+        with open(target_path.with_suffix(".lrc"), "w", encoding="utf-8") as f:
+            f.write(lrc_lyrics)
+
 
-    set_tags(target_path, track, text_lyrics, cover, compatibility_level)
+def _download_info_sort_key(e: DownloadInfo) -> Union[int, float]:
+    aac_multiplier = 1.5
+    bitrate = e.bitrate_in_kbps
+    if bitrate <= 192:
+        aac_multiplier = 0.5
+    if e.codec == "aac":
+        bitrate *= aac_multiplier
+    return bitrate
 
 
 def to_downloadable_track(
@@ -310,22 +558,13 @@ def to_downloadable_track(
         bitrate = download_info.bitrate
     else:
         download_info = track.get_download_info(get_direct_links=True)
-        download_info = [e for e in download_info if e.codec in ("mp3", "aac")]
-
-        def sort_key(e: DownloadInfo) -> Union[int, float]:
-            aac_multiplier = 1.5
-            bitrate = e.bitrate_in_kbps
-            if bitrate <= 192:
-                aac_multiplier = 0.5
-            if e.codec == "aac":
-                bitrate *= aac_multiplier
-            return bitrate
-
-        download_info.sort(
-            key=sort_key,
-            reverse=quality == 0,
+        # Iterate in reverse so ties resolve to the same entry the previous
+        # stable sort picked
+        pick = min if quality == 0 else max
+        target_info = pick(
+            (e for e in reversed(download_info) if e.codec in LOSSY_CODECS),
+            key=_download_info_sort_key,
         )
-        target_info = download_info[-1]
         url = typing.cast(str, target_info.direct_link)
         bitrate = target_info.bitrate_in_kbps
         codec = target_info.codec
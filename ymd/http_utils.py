@@ -0,0 +1,69 @@
+import threading
+from pathlib import Path
+
+import requests
+from requests.adapters import HTTPAdapter, Retry
+from yandex_music.utils.request import USER_AGENT
+
+DEFAULT_TIMEOUT = 20
+DEFAULT_POOL_SIZE = 32
+POOL_CONNECTIONS = 16
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+WRITE_BUFFER_SIZE = 1024 * 1024
+MAX_RETRIES = 3
+RETRY_BACKOFF_FACTOR = 0.3
+# Audio is already compressed, don't ask the server to compress it again
+DOWNLOAD_HEADERS = {"Accept-Encoding": "identity"}
+
+_timeout = DEFAULT_TIMEOUT
+_cancelled = threading.Event()
+
+
+def _mount_adapter(session: requests.Session, pool_size: int) -> None:
+    retries = Retry(total=MAX_RETRIES, backoff_factor=RETRY_BACKOFF_FACTOR)
+    adapter = HTTPAdapter(
+        pool_connections=POOL_CONNECTIONS, pool_maxsize=pool_size, max_retries=retries
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+
+def _create_session() -> requests.Session:
+    session = requests.Session()
+    session.headers["User-Agent"] = USER_AGENT
+    _mount_adapter(session, DEFAULT_POOL_SIZE)
+    return session
+
+
+SESSION = _create_session()
+
+
+def set_timeout(timeout: int) -> None:
+    global _timeout
+    _timeout = timeout
+
+
+def set_pool_size(pool_size: int) -> None:
+    _mount_adapter(SESSION, pool_size)
+
+
+def cancel_downloads() -> None:
+    _cancelled.set()
+
+
+def retrieve(url: str) -> bytes:
+    resp = SESSION.get(url, timeout=_timeout)
+    resp.raise_for_status()
+    return resp.content
+
+
+def download(url: str, path: Path) -> None:
+    with SESSION.get(
+        url, timeout=_timeout, stream=True, headers=DOWNLOAD_HEADERS
+    ) as resp:
+        resp.raise_for_status()
+        with open(path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+            for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                if _cancelled.is_set():
+                    raise RuntimeError("Download cancelled")
+                f.write(chunk)